@@ -1,5 +1,7 @@
 import threading
 import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
 from typing import Any, List, Dict, Tuple, Optional
 
@@ -11,6 +13,20 @@ from app.plugins import _PluginBase
 from app.schemas import TransferInfo, RefreshMediaItem, ServiceInfo
 from app.schemas.types import EventType
 
+__all__ = ["MediaServerRefresh"]
+
+# 媒体服务器实例缓存有效期（秒）
+_SVC_TTL = 30.0
+# 配置页媒体服务器选项缓存有效期（秒）
+_FORM_TTL = 60.0
+
+# 媒体服务器刷新能力
+_CAP_BY_ITEMS = 1
+_CAP_ROOT = 2
+
+# 队列中的轻量刷新项目，下发刷新前再转换为 RefreshMediaItem
+_RefreshItem = namedtuple("_RefreshItem", "title year type category target_path")
+
 
 class MediaServerRefresh(_PluginBase):
     # 插件名称
@@ -36,42 +52,115 @@ class MediaServerRefresh(_PluginBase):
     _enabled = False
     _delay = 0
     _mediaservers = None
+    # 需要逐个下发刷新请求的媒体服务器类型
+    _per_item_servers = {"emby"}
+    _helper: Optional[MediaServerHelper] = None
+    # 媒体服务器实例缓存：(缓存时间, 可用服务, 各服务刷新能力, 媒体服务器配置)
+    _svc_cache: Optional[Tuple[float, Dict[str, ServiceInfo], Dict[str, int], tuple]] = None
+    # 配置页媒体服务器选项缓存：(缓存时间, 选项)
+    _form_cache: Optional[Tuple[float, List[dict]]] = None
+    # 逐个下发时各媒体服务器的最小调用间隔及上次调用时间
+    _min_interval: Dict[str, float] = {}
+    _last_call: Dict[str, float] = {}
+    # 已提示过不支持刷新的媒体服务器
+    _warned_servers: set = set()
 
     # 延迟相关的属性
-    _in_delay = False
-    _pending_items: List[RefreshMediaItem] = []
+    # 待刷新项目，按媒体信息及刷新路径去重
+    _pending_items: Dict[_RefreshItem, None] = OrderedDict()
     _end_time = 0.0
     _lock = threading.Lock()
+    # 用于通知延迟刷新线程
+    _cv = threading.Condition(_lock)
+    _stopped = False
+    _worker: Optional[threading.Thread] = None
+    # 并发刷新各媒体服务器的线程池
+    _pool: Optional[ThreadPoolExecutor] = None
+    # 执行延迟刷新的线程池，限制同时进行的刷新批次数
+    _flush_pool: Optional[ThreadPoolExecutor] = None
 
     def init_plugin(self, config: dict = None):
+        self._helper = MediaServerHelper()
+        self._svc_cache = None
+        self._form_cache = None
+        self._min_interval = {}
+        self._last_call = {}
+        self._warned_servers = set()
         if config:
             self._enabled = config.get("enabled")
             self._delay = int(config.get("delay") or 0)
             self._mediaservers = config.get("mediaservers") or []
 
+        if not self._pool:
+            self._pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="msr")
+        if not self._flush_pool:
+            self._flush_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="msr-flush")
+
+        if self._enabled and self._delay > 0:
+            # 启动常驻的延迟刷新线程，事件到达时只需通知
+            with self._cv:
+                self._stopped = False
+                # 重新加载配置时复用尚未退出的线程，线程退出前会在锁内注销自身
+                if not self._worker:
+                    self._worker = threading.Thread(target=self._debounce_loop, daemon=True)
+                    self._worker.start()
+
     @property
     def service_infos(self) -> Optional[Dict[str, ServiceInfo]]:
+        return self._get_services()[0]
+
+    def _get_services(self) -> Tuple[Optional[Dict[str, ServiceInfo]], Dict[str, int]]:
+        """
+        获取可用的媒体服务器实例及其支持的刷新能力，两者一同缓存
+        """
         if not self._mediaservers:
             logger.warning("尚未配置媒体服务器，请检查配置")
-            return None
+            return None, {}
+
+        # 短时间内复用上次的结果，避免每次都检查服务器连接状态
+        cache = self._svc_cache
+        mediaservers = tuple(self._mediaservers)
+        if cache and time.monotonic() - cache[0] < _SVC_TTL and cache[3] == mediaservers:
+            return cache[1], cache[2]
 
-        services = MediaServerHelper().get_services(name_filters=self._mediaservers)
+        services = self._helper.get_services(name_filters=self._mediaservers)
         if not services:
             logger.warning("获取媒体服务器实例失败，请检查配置")
-            return None
+            return None, {}
 
         active_services = {}
+        service_caps = {}
         for service_name, service_info in services.items():
             if service_info.instance.is_inactive():
                 logger.warning(f"媒体服务器 {service_name} 未连接，请检查配置")
             else:
                 active_services[service_name] = service_info
+                instance = service_info.instance
+                service_caps[service_name] = \
+                    (_CAP_BY_ITEMS if hasattr(instance, 'refresh_library_by_items') else 0) \
+                    | (_CAP_ROOT if hasattr(instance, 'refresh_root_library') else 0)
 
-        return active_services if active_services else None
+        if not active_services:
+            return None, {}
+        # 仅缓存可用结果，服务器恢复连接后可立即使用
+        self._svc_cache = (time.monotonic(), active_services, service_caps, mediaservers)
+        return active_services, service_caps
 
     def get_state(self) -> bool:
         return self._enabled
 
+    def _server_choices(self) -> List[dict]:
+        """
+        配置页可选的媒体服务器，短时间内复用，避免每次渲染都读取配置
+        """
+        cache = self._form_cache
+        if cache and time.monotonic() - cache[0] < _FORM_TTL:
+            return cache[1]
+        choices = [{"title": config.name, "value": config.name}
+                   for config in self._helper.get_configs().values()]
+        self._form_cache = (time.monotonic(), choices)
+        return choices
+
     def get_form(self) -> Tuple[List[dict], Dict[str, Any]]:
         return [
             {
@@ -107,8 +196,7 @@ class MediaServerRefresh(_PluginBase):
                                             'clearable': True,
                                             'model': 'mediaservers',
                                             'label': '媒体服务器',
-                                            'items': [{"title": config.name, "value": config.name}
-                                                      for config in MediaServerHelper().get_configs().values()]
+                                            'items': self._server_choices()
                                         }
                                     }
                                 ]
@@ -147,23 +235,21 @@ class MediaServerRefresh(_PluginBase):
         if not event_info:
             return
 
-        # 获取媒体服务器实例
-        active_services = self.service_infos
-        if not active_services:
-            return
-
         # 解析转移信息
         transferinfo: TransferInfo = event_info.get("transferinfo")
         if not transferinfo or not transferinfo.target_diritem or not transferinfo.target_diritem.path:
             return
 
         # 1. 路径预处理：如果是文件，则获取其所属文件夹（去重核心）
-        target_path = Path(transferinfo.target_diritem.path)
-        refresh_path = target_path.parent if target_path.is_file() else target_path
+        fileitem = transferinfo.target_diritem
+        target_path = Path(fileitem.path)
+        # 优先使用文件项自带的类型，避免访问文件系统
+        is_file = fileitem.type == "file" if fileitem.type else target_path.is_file()
+        refresh_path = target_path.parent if is_file else target_path
 
         # 2. 构造刷新项目
         mediainfo: MediaInfo = event_info.get("mediainfo")
-        item = RefreshMediaItem(
+        item = _RefreshItem(
             title=mediainfo.title,
             year=mediainfo.year,
             type=mediainfo.type,
@@ -171,62 +257,161 @@ class MediaServerRefresh(_PluginBase):
             target_path=refresh_path,
         )
 
-        def debounce_delay(duration: int):
-            """延迟防抖优化"""
-            with self._lock:
-                self._end_time = time.time() + float(duration)
-                if self._in_delay:
-                    return False
-                self._in_delay = True
+        # 3. 延迟逻辑处理：加入待刷新队列，由延迟刷新线程统一刷新
+        if self._delay > 0:
+            # 入队时即合并重复项目
+            with self._cv:
+                self._pending_items[item] = None
+                self._end_time = time.monotonic() + float(self._delay)
+                self._cv.notify()
+            logger.info(f"项目 {item.title} 已加入队列，等待 {self._delay} 秒后统一刷新...")
+            return
+
+        # 4. 分发刷新请求
+        self._do_refresh([item])
 
-            while time.time() < self._end_time:
-                time.sleep(1)
+    def _debounce_loop(self):
+        """
+        延迟刷新线程：队列中有项目且最后一个事件后的延迟时间已过时统一刷新
+        """
+        while True:
+            with self._cv:
+                while not self._stopped and not self._pending_items:
+                    self._cv.wait()
+                # 新事件会推迟结束时间并通知，重新计算剩余等待时间
+                while not self._stopped:
+                    remaining = self._end_time - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cv.wait(remaining)
+                stopped = self._stopped
+                if stopped:
+                    # 在锁内注销，之后重新加载配置会创建新的线程
+                    self._worker = None
+            items = self._drain_pending()
+            if stopped:
+                # 停止时立即刷新已入队的项目后退出，不丢弃待刷新项目
+                if items:
+                    self._flush(items)
+                return
+            # 交由独立线程池刷新，刷新期间到达的新事件可立即开始下一轮延迟；
+            # 媒体服务器实例在刷新时再获取，不跨越延迟窗口持有
+            flush_pool = self._flush_pool
+            if flush_pool:
+                try:
+                    flush_pool.submit(self._flush, items)
+                    continue
+                except RuntimeError:
+                    # 插件停止时线程池已关闭，改为在当前线程刷新
+                    pass
+            self._flush(items)
 
-            with self._lock:
-                self._in_delay = False
-            return True
+    def _flush(self, items: List[_RefreshItem]):
+        """
+        执行一批延迟刷新，记录异常，避免在线程池中被静默丢弃
+        """
+        try:
+            self._do_refresh(items)
+        except Exception as e:
+            logger.error(f"刷新 {len(items)} 个项目失败: {str(e)}")
 
-        # 3. 加入待刷新队列并去重
+    def _drain_pending(self) -> List[_RefreshItem]:
+        """
+        取出待刷新队列中的全部项目，锁内仅交换队列引用，旧队列在锁外释放
+        """
         with self._lock:
-            # 检查队列中是否已存在相同路径
-            if not any(str(x.target_path) == str(item.target_path) for x in self._pending_items):
-                self._pending_items.append(item)
-            else:
-                logger.debug(f"路径 {refresh_path} 已在刷新队列中，跳过添加")
+            pending, self._pending_items = self._pending_items, OrderedDict()
+        return list(pending)
 
-        # 4. 延迟逻辑处理
-        if self._delay > 0:
-            logger.info(f"项目 {item.title} 已加入队列，等待 {self._delay} 秒后统一刷新...")
-            if not debounce_delay(self._delay):
-                # 仍在延迟中，由第一个启动的线程负责后续执行
+    def _do_refresh(self, items: List[_RefreshItem]):
+        """
+        通知各媒体服务器刷新，媒体服务器实例在此统一获取
+        :param items: 待刷新项目
+        """
+        services, service_caps = self._get_services()
+        if not services:
+            return
+
+        # 所有媒体服务器共用同一批刷新项目
+        items = [RefreshMediaItem(**i._asdict()) for i in items]
+
+        pool = self._pool
+        if not pool or len(services) == 1:
+            for name, service in services.items():
+                self._refresh_one(name, service, service_caps.get(name, 0), items)
+            return
+
+        # 各媒体服务器之间互不影响，并发下发刷新请求
+        futures = {}
+        for name, service in services.items():
+            try:
+                futures[pool.submit(self._refresh_one, name, service,
+                                    service_caps.get(name, 0), items)] = name
+            except RuntimeError:
+                # 插件停止时线程池已关闭，改为在当前线程刷新
+                self._refresh_one(name, service, service_caps.get(name, 0), items)
+        done, not_done = wait(futures, timeout=60)
+        for future in done:
+            if future.exception():
+                logger.error(f"[{futures[future]}] 刷新失败: {str(future.exception())}")
+        for future in not_done:
+            logger.warning(f"[{futures[future]}] 刷新超时，仍在后台执行")
+
+    def _refresh_one(self, name: str, service: ServiceInfo, caps: int, items: List[RefreshMediaItem]):
+        """
+        通知单个媒体服务器刷新
+        :param name: 媒体服务器名称
+        :param service: 媒体服务器实例
+        :param caps: 媒体服务器支持的刷新能力
+        :param items: 待刷新项目
+        """
+        instance = service.instance
+        if caps & _CAP_BY_ITEMS:
+            paths = [str(i.target_path) for i in items[:3]]
+            logger.info(f"[{name}] 通知刷新 {len(items)} 个路径: {paths}{'...' if len(items) > 3 else ''}")
+            if service.type not in self._per_item_servers:
+                # 支持批量刷新的服务器一次性下发
+                try:
+                    instance.refresh_library_by_items(items)
+                    logger.debug(f"[{name}] 成功下发 {len(items)} 个项目的刷新指令")
+                except Exception as e:
+                    logger.error(f"[{name}] 批量刷新失败: {str(e)}")
                 return
-            
-            with self._lock:
-                items_to_process = self._pending_items[:]
-                self._pending_items = []
-        else:
-            items_to_process = [item]
-
-        # 5. 分发刷新请求
-        for name, service in active_services.items():
-            instance = service.instance
-            if hasattr(instance, 'refresh_library_by_items'):
-                logger.info(f"[{name}] 开始刷新队列中的 {len(items_to_process)} 个项目...")
-                for r_item in items_to_process:
-                    try:
-                        # 逐个下发，确保 Emby 能够正确排队处理
-                        instance.refresh_library_by_items([r_item])
-                        logger.info(f"[{name}] 成功下发刷新指令: {r_item.title} ({r_item.target_path})")
-                        # 加入 1 秒间隔，保护服务器
-                        time.sleep(1)
-                    except Exception as e:
-                        logger.error(f"[{name}] 刷新 {r_item.title} 失败: {str(e)}")
-            elif hasattr(instance, 'refresh_root_library'):
-                logger.info(f"[{name}] 不支持按项刷新，执行全量库刷新")
-                instance.refresh_root_library()
-            else:
-                logger.warning(f"[{name}] 未找到可用的刷新接口")
+            success = 0
+            for r_item in items:
+                # 仅在服务器出错后才拉开调用间隔，避免持续冲击服务器
+                wait_time = self._min_interval.get(name, 0.0) - (time.monotonic() - self._last_call.get(name, 0.0))
+                if wait_time > 0:
+                    time.sleep(wait_time)
+                try:
+                    # 逐个下发，确保 Emby 能够正确排队处理
+                    instance.refresh_library_by_items([r_item])
+                    logger.debug(f"[{name}] 成功下发刷新指令: {r_item.title} ({r_item.target_path})")
+                    self._min_interval[name] = self._min_interval.get(name, 0.0) * 0.9
+                    success += 1
+                except Exception as e:
+                    logger.error(f"[{name}] 刷新 {r_item.title} 失败: {str(e)}")
+                    self._min_interval[name] = min(2.0, max(0.2, self._min_interval.get(name, 0.0) * 2))
+                self._last_call[name] = time.monotonic()
+            logger.info(f"[{name}] 刷新指令下发完成，成功 {success}/{len(items)} 个")
+        elif caps & _CAP_ROOT:
+            logger.info(f"[{name}] 不支持按项刷新，执行全量库刷新")
+            instance.refresh_root_library()
+        elif name not in self._warned_servers:
+            # 同一媒体服务器只提示一次
+            self._warned_servers.add(name)
+            logger.warning(f"[{name}] 未找到可用的刷新接口")
 
     def stop_service(self):
-        with self._lock:
+        with self._cv:
+            self._stopped = True
             self._end_time = 0.0
+            # 立即唤醒延迟刷新线程，刷新剩余项目后退出
+            self._cv.notify_all()
+        # 已从队列取出的批次不取消，由线程池执行完毕
+        if self._pool:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+        if self._flush_pool:
+            self._flush_pool.shutdown(wait=False)
+            self._flush_pool = None